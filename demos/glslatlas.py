@@ -1,4 +1,7 @@
-import json
+try:
+    import orjson as json
+except ImportError:
+    import json
 
 from kivy.app import App
 from kivy.core.image import Image
@@ -9,7 +12,7 @@ from kivy.uix.widget import Widget
 
 def load_atlas(atlas_name):
     with open(atlas_name, 'rb') as fh:
-        atlas = json.loads(fh.read().decode('utf-8'))
+        atlas = json.loads(fh.read())
         tex_name, mapping = atlas.popitem()
 
         # We might have to find the abs location of the image if its in a diff.
@@ -1,9 +1,22 @@
-import pdb
-import math
-import json
+import threading
+import time
+from functools import lru_cache
+from types import MappingProxyType
 from random import randint, random
 from collections import namedtuple
 
+import numpy as np
+
+try:
+    import orjson as json
+except ImportError:
+    import json
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
 from kivy.app import App
 from kivy.core.image import Image
 from kivy.core.window import Window
@@ -25,9 +38,17 @@ sv - Sprite height divided by 2
 """
 
 
+@lru_cache(maxsize=None)
 def load_atlas(atlas_name):
+    """ Load the texture and UV mapping of an atlas.
+
+    Results are cached per atlas file so renderers sharing an atlas also share
+    the texture. The UV mapping is returned as a read-only view since it's
+    shared as well.
+
+    """
     with open(atlas_name, 'rb') as fh:
-        atlas = json.loads(fh.read().decode('utf-8'))
+        atlas = json.loads(fh.read())
         tex_name, mapping = atlas.popitem()
 
         # We might have to find the abs location of the image if its in a diff.
@@ -45,7 +66,35 @@ def load_atlas(atlas_name):
                 0.5 * w, 0.5 * h
             )
 
-        return tex, uvmap
+        return tex, MappingProxyType(uvmap)
+
+
+def _sync_vertices_loop(xs, ys, sizes, vdata):
+    """ Copy the particle state arrays into the first 3 columns of every
+    vertex of the particles' quads.
+
+    This is what `sync_vertices` runs when Numba is available, compiled so
+    that the copy is a single fused loop without any temporaries. Otherwise
+    `sync_vertices` does the same copy with NumPy broadcasts.
+
+    """
+    for i in range(xs.shape[0]):
+        for k in range(4):
+            vdata[i, k, 0] = xs[i]
+            vdata[i, k, 1] = ys[i]
+            vdata[i, k, 2] = sizes[i]
+
+
+if njit is not None:
+    sync_vertices = njit(cache=True)(_sync_vertices_loop)
+else:
+    def sync_vertices(xs, ys, sizes, vdata):
+        """ NumPy version of `_sync_vertices_loop`.
+
+        """
+        vdata[:, :, 0] = xs[:, None]
+        vdata[:, :, 1] = ys[:, None]
+        vdata[:, :, 2] = sizes[:, None]
 
 
 class PSWidget(Widget):
@@ -53,10 +102,14 @@ class PSWidget(Widget):
 
     An instance of this renderer will only hold a single source of texture.
 
+    Particle state is kept as a structure of arrays (`xs`, `ys`, `sizes`)
+    indexed by the particle's index. Every frame these are broadcast into the
+    first 3 columns of the `(max_particles, 4, vsize)` vertex buffer `vdata`;
+    the remaining columns (sprite offsets and UVs) are static and written
+    once in `make_particles`.
+
     """
-    indices = []
-    vertices = []
-    particles = []
+    max_particles = 0
 
     def __init__(self, **kwargs):
         super(PSWidget, self).__init__(**kwargs)
@@ -72,8 +125,40 @@ class PSWidget(Widget):
 
         self.vsize = sum(attr[1] for attr in self.vfmt)
 
+        self.particles = []
+        self.batches = []
+        self.mesh = None
+        self.xs = np.zeros(self.max_particles, dtype=np.float32)
+        self.ys = np.zeros(self.max_particles, dtype=np.float32)
+        self.sizes = np.ones(self.max_particles, dtype=np.float32)
+        self.vdata = np.zeros((self.max_particles, 4, self.vsize),
+                              dtype=np.float32)
+
+        # Two triangles per quad: (0, 1, 2) and (2, 3, 0). The indices are
+        # uint16 so every vertex has to be addressable with 16 bits.
+        if 4 * self.max_particles > 0x10000:
+            raise ValueError('At most {} particles are supported, got '
+                             '{}'.format(0x10000 // 4, self.max_particles))
+
+        j = 4 * np.arange(self.max_particles, dtype=np.uint16)[:, None]
+        self.indices = (
+            j + np.array((0, 1, 2, 2, 3, 0), dtype=np.uint16)).ravel()
+
+        # Also gets the kernel compiled before the first frame
+        sync_vertices(self.xs, self.ys, self.sizes, self.vdata)
+
         self.texture, self.uvmap = load_atlas(self.atlas)
 
+        # The per-vertex sprite offsets and UVs of each sprite's quad
+        self.corners = {}
+        for name, uv in self.uvmap.items():
+            self.corners[name] = np.array((
+                (-uv.su, -uv.sv, uv.u0, uv.v1),
+                (uv.su, -uv.sv, uv.u1, uv.v1),
+                (uv.su, uv.sv, uv.u1, uv.v0),
+                (-uv.su, uv.sv, uv.u0, uv.v0),
+            ), dtype=np.float32)
+
     def make_particles(self, Cls, num):
         """ Convenience method to add a large number (`num`) of similar
         particles 
@@ -87,52 +172,73 @@ class PSWidget(Widget):
 
         num (int) - Number of particles to add.
 
+
+        Returns
+        -------
+
+        slice - The range of indices these particles occupy in the state
+            arrays.
+
         """
         count = len(self.particles)
-        uv = self.uvmap[Cls.tex_name]
+        if count + num > self.max_particles:
+            raise ValueError('Cannot add {} particles; only {} of {} slots '
+                             'left'.format(num, self.max_particles - count,
+                                           self.max_particles))
 
-        for i in range(count, count + num):
-            j = 4 * i
-            self.indices.extend((
-                j, j + 1, j + 2, j + 2, j + 3, j))
-            self.vertices.extend((
-                0, 0, 1, -uv.su, -uv.sv, uv.u0, uv.v1,
-                0, 0, 1, uv.su, -uv.sv, uv.u1, uv.v1,
-                0, 0, 1, uv.su, uv.sv, uv.u1, uv.v0,
-                0, 0, 1, -uv.su, uv.sv, uv.u0, uv.v0,
-            ))
+        self.vdata[count:count + num, :, 3:] = self.corners[Cls.tex_name]
 
+        for i in range(count, count + num):
             p = Cls(self, i)
             self.particles.append(p)
 
+        # Particles without an advance step are moved by the renderer itself
+        s = slice(count, count + num)
+        if Cls.advance_batch is not None:
+            self.batches.append((Cls, s))
+
+        # The indices never change between frames so they're only pushed
+        # when the number of particles does. `vertices` is a flat float32 view
+        # of the used part of `vdata` which Kivy can copy in bulk.
+        n = count + num
+        self.vertices = self.vdata[:n].reshape(-1)
+        if self.mesh is None:
+            with self.canvas:
+                self.mesh = Mesh(
+                    fmt=self.vfmt, mode='triangles',
+                    indices=self.indices[:6 * n], vertices=self.vertices,
+                    texture=self.texture)
+        else:
+            self.mesh.vertices = self.vertices
+            self.mesh.indices = self.indices[:6 * n]
+
+        return s
+
     def update_glsl(self, nap):
         """ Update the canvas.
 
-        NOTES: Take the ff. into consideration when optimization is necessary:
-
-        The particles update loop:
-        - This loop should parallelized in full or partially.
-        - This could also be run on another thread completely, and not update
-            on every frame. This may apply to selected particle sub-classes,
-            i.e. stuff in the background that doesn't affect program flow.
+        NOTES: The particles update loop only makes one `advance_batch` call
+        per particle class, most of which are vectorized over the state
+        arrays. Particles in the background that don't affect program flow
+        (i.e. the starfield) are moved on another thread at their own rate and
+        are only copied into the state arrays here.
 
 
         Parameters
         ----------
 
-        nap (float) - TODO
+        nap (float) - Seconds elapsed since the previous tick.
 
         """
-        # Update the state of all particles
-        for p in self.particles:
-            p.advance(nap)
-            p.update()
+        # Update the state of all particles, one batch per particle class
+        for Cls, s in self.batches:
+            Cls.advance_batch(self, nap, s)
+
+        # Sync the particle state with the vertices array
+        sync_vertices(self.xs, self.ys, self.sizes, self.vdata)
 
         # Draw the changes
-        self.canvas.clear()
-        with self.canvas:
-            Mesh(fmt=self.vfmt, mode='triangles', indices=self.indices,
-                 vertices=self.vertices, texture=self.texture)
+        self.mesh.vertices = self.vertices
 
 
 class Particle(object):
@@ -140,9 +246,10 @@ class Particle(object):
 
     Each particle is tightly-coupled to a renderer class and vice-versa. This
     improves performance such that each particle will have direct access to the
-    vertices array in the renderer. This means less copying of the vertices
-    array, taking into account that there could be many particles active at the
-    same time.
+    state arrays in the renderer. The `x`, `y` and `size` attributes read and
+    write straight into the renderer's `xs`, `ys` and `sizes` arrays, so no
+    copying is needed, taking into account that there could be many particles
+    active at the same time.
 
 
     Parameters
@@ -150,19 +257,16 @@ class Particle(object):
 
     parent (obj) - Reference to the renderer this particle belongs to.
     i (int) - Reference to this particle's index in the total number of as per
-        the total number of particles in a renderer. This is used to compute
-        for the `base_i` which is the index of this particle's vertex in the
-        array of vertices.
+        the total number of particles in a renderer. This is the index of this
+        particle's state in the renderer's state arrays and of its quad in
+        `vdata`.
 
     """
-    x = 0
-    y = 0
-    size = 1
+    __slots__ = ('parent', 'i')
 
     def __init__(self, parent, i):
         self.parent = parent
-        self.vsize = parent.vsize
-        self.base_i = 4 * i * self.vsize
+        self.i = i
         self.reset(created=True)
 
     def reset(self, created=False):
@@ -179,27 +283,49 @@ class Particle(object):
         """
         raise NotImplementedError()
 
-    def advance(self, nap):
-        """ Computes for this particle's new state. Not necessarily showing any
-        visible changes.
+    @classmethod
+    def advance_batch(cls, parent, nap, s):
+        """ Computes for the new state of all the particles of this class. Not
+        necessarily showing any visible changes.
+
+        Sub-classes should implement this as a vectorized update that works
+        directly on the renderer's state arrays. Sub-classes that the renderer
+        moves by itself can set this to `None` to be skipped.
 
 
         Parameters
         ----------
 
-        nap (float) - TODO
+        parent (obj) - Reference to the renderer the particles belong to.
+        nap (float) - Seconds elapsed since the previous tick.
+        s (slice) - The range of indices of the particles in the renderer.
 
         """
         raise NotImplementedError()
 
-    def update(self):
-        """ Sync all internal state changes with the vertices array if any.
+    @property
+    def x(self):
+        return self.parent.xs[self.i]
 
-        """
-        for i in range(self.base_i,
-                       self.base_i + 4 * self.vsize,
-                       self.vsize):
-            self.parent.vertices[i:i + 3] = (self.x, self.y, self.size)
+    @x.setter
+    def x(self, value):
+        self.parent.xs[self.i] = value
+
+    @property
+    def y(self):
+        return self.parent.ys[self.i]
+
+    @y.setter
+    def y(self, value):
+        self.parent.ys[self.i] = value
+
+    @property
+    def size(self):
+        return self.parent.sizes[self.i]
+
+    @size.setter
+    def size(self, value):
+        self.parent.sizes[self.i] = value
 
 
 class Star(Particle):
@@ -208,25 +334,62 @@ class Star(Particle):
     There will be 3 planes. The stars spawned in the furthest plane will move
     slower than the ones spawned nearest to the player.
 
+    A star's size is derived from its plane (`0.1 * plane`), so the plane is
+    read back from the renderer's `sizes` array instead of being stored.
+
+    Stars don't affect program flow so they're moved on a background thread
+    by `Game.star_loop` which publishes their state into the renderer's
+    `star_state` buffer. Advancing them on the render thread only copies that
+    state into the state arrays, and only when a new one was published.
+
     """
+    __slots__ = ()
     tex_name = 'star'
-    plane = 1
 
     def reset(self, created=False):
-        self.plane = randint(1, 3)
+        p = self.parent
+        plane = randint(1, 3)
 
         if created:
-            self.x = random() * self.parent.width
+            self.x = random() * p.width
         else:
-            self.x = self.parent.width
+            self.x = p.width
+
+        self.y = random() * p.height
+        self.size = 0.1 * plane
+
+    @classmethod
+    def advance_batch(cls, parent, nap, s):
+        if parent.star_generation == parent.star_synced:
+            return
+
+        with parent.star_lock:
+            parent.xs[s], parent.ys[s], parent.sizes[s] = parent.star_state
+            parent.star_synced = parent.star_generation
+
+    @staticmethod
+    def advance_field(xs, ys, sizes, nap, width, height):
+        """ Computes for the new state of the starfield in place.
+
+
+        Parameters
+        ----------
 
-        self.y = random() * self.parent.height
-        self.size = 0.1 * self.plane
+        xs, ys, sizes (ndarray) - The state of all the stars.
+        nap (float) - Seconds elapsed since the previous tick.
+        width, height (float) - The size of the screen.
 
-    def advance(self, nap):
-        self.x -= 20 * self.plane * nap
-        if self.x < 0:
-            self.reset()
+        """
+        # 20 * plane, with the plane being 10 * size
+        xs -= 200.0 * sizes * nap
+
+        # Respawn the stars that left the screen on the right edge
+        m = xs < 0
+        n = int(m.sum())
+        if n:
+            xs[m] = width
+            ys[m] = np.random.rand(n) * height
+            sizes[m] = 0.1 * np.random.randint(1, 4, n)
 
 
 class Trail(Particle):
@@ -237,125 +400,207 @@ class Trail(Particle):
     of its size, we reset it.
 
     """
+    __slots__ = ()
     tex_name = 'trail'
 
     def reset(self, created=False):
-        self.x = self.parent.player_x + randint(-30, -20)
-        self.y = self.parent.player_y + randint(-10, 10)
+        p = self.parent
+        self.x = p.player_x + randint(-30, -20)
+        self.y = p.player_y + randint(-10, 10)
 
         if created:
             self.size = 0
         else:
             self.size = random() + 0.6
 
-    def advance(self, nap):
-        self.size -= nap
-        if self.size <= 0.1:
-            self.reset()
-        else:
-            self.x -= 120 * nap
+    @classmethod
+    def advance_batch(cls, parent, nap, s):
+        xs, ys, sizes = parent.xs[s], parent.ys[s], parent.sizes[s]
+
+        sizes -= nap
+        m = sizes <= 0.1
+        xs[~m] -= 120 * nap
+
+        # Respawn the shrunken flames near the engine
+        n = int(m.sum())
+        if n:
+            xs[m] = parent.player_x + np.random.randint(-30, -19, n)
+            ys[m] = parent.player_y + np.random.randint(-10, 11, n)
+            sizes[m] = np.random.rand(n) + 0.6
 
 
 class Player(Particle):
     """ The player particle just follows the mouse position
 
+    It's moved directly by `Game.update_glsl` so it doesn't have an advance
+    step.
+
     """
+    __slots__ = ()
     tex_name = 'player'
 
     def reset(self, created=False):
-        self.x = self.parent.player_x
-        self.y = self.parent.player_y
+        p = self.parent
+        self.x = p.player_x
+        self.y = p.player_y
+
+    advance_batch = None
 
-    advance = reset
 
+class Spawnable(Particle):
+    """ Component abstract class for particles that can be spawned and
+    despawned during play.
 
-class Bullet(Particle):
+    The `active` flag reads and writes straight into the renderer's `active`
+    array so that all particles of a class can be checked at once.
+
+    """
+    __slots__ = ()
+
+    @property
+    def active(self):
+        return self.parent.active[self.i]
+
+    @active.setter
+    def active(self, value):
+        self.parent.active[self.i] = value
+
+
+class Bullet(Spawnable):
+    __slots__ = ()
     tex_name = 'bullet'
-    active = False
 
     def reset(self, created=False):
         self.active = False
         self.x = -100
         self.y = -100
 
-    def advance(self, nap):
-        if self.active:
-            self.x += 250 * nap
-            if self.x > self.parent.width:
-                self.reset()
-        elif self.parent.firing and self.parent.fire_delay <= 0:
-            self.active = True
-            self.x = self.parent.player_x + 40
-            self.y = self.parent.player_y
-            self.parent.fire_delay += 0.3333
-
+    @classmethod
+    def advance_batch(cls, parent, nap, s):
+        xs, ys = parent.xs[s], parent.ys[s]
+        active = parent.active[s]
+        idle = ~active
+
+        # Fly to the right. When we leave the screen, reset.
+        xs[active] += 250 * nap
+        gone = active & (xs > parent.width)
+        active[gone] = False
+        xs[gone] = -100
+        ys[gone] = -100
+
+        # Fire from the bullets that weren't in flight this frame
+        delay = parent.fire_delay
+        if parent.firing and delay <= 0:
+            px, py = parent.player_x, parent.player_y
+            for k in np.flatnonzero(idle):
+                active[k] = True
+                xs[k] = px + 40
+                ys[k] = py
+                delay += 0.3333
+                if delay > 0:
+                    break
+            parent.fire_delay = delay
+
+
+class Enemy(Spawnable):
+    """ The UFOs that fly in from the right
+
+    The vertical speeds of all the enemies are kept in the renderer's
+    `enemy_v` array.
 
-class Enemy(Particle):
-    active = False
+    """
+    __slots__ = ()
     tex_name = 'ufo'
-    v = 0
+
+    # How close the player or a bullet has to be for us to get hit
+    player_reach = 60
+    bullet_reach = 30
 
     def reset(self, created=False):
         self.active = False
         self.x = -100
         self.y = -100
-        v = 0
-
-    def advance(self, nap):
-        if self.active:
-            # If we're hit, reset.
-            if self.check_hit():
-                self.reset()
-                return
-
-            # Continue moving to the left. When we leave the screen, reset.
-            self.x -= 200 * nap
-            if self.x < -50:
-                self.reset()
-                return
-
-            # Move vertically. If we're leaving the view, change the vector
-            # sign
-            self.y += self.v * nap
-            if self.y <= 0:
-                self.v = abs(self.v)
-            elif self.y > self.parent.height:
-                self.v = -abs(self.v)
-        elif self.parent.spawn_delay <= 0:
-            self.active = True
-            self.x = self.parent.width + 50
-            self.y = self.parent.height * random()
-            self.v = randint(-100, 100)
-            self.parent.spawn_delay += 1
-
-    def check_hit(self):
-
-        # Check if we've collide with the player
-        if math.hypot(self.parent.player_x - self.x,
-                      self.parent.player_y - self.y) < 60:
-            return True
-
-        # Check if we've collide with an active bullet
-        for b in self.parent.bullets:
-            if not b.active:
-                continue
-            if math.hypot(b.x - self.x, b.y - self.y) < 30:
-                b.reset()
-                return True
-
-
-        return False
+
+    @classmethod
+    def advance_batch(cls, parent, nap, s):
+        xs, ys = parent.xs[s], parent.ys[s]
+        active = parent.active[s]
+        idle = ~active
+        v = parent.enemy_v
+
+        bs = parent.bullet_slice
+        bxs, bys = parent.xs[bs], parent.ys[bs]
+        b_active = parent.active[bs]
+
+        # Check if we've collided with the player
+        dx = xs - parent.player_x
+        dy = ys - parent.player_y
+        hit = active & (dx * dx + dy * dy < cls.player_reach ** 2)
+
+        # Check if we've collided with an active bullet. Compare squared
+        # distances so we don't need to take any square roots. Most frames
+        # either have no bullets in flight or no enemies, so skip it then.
+        shootable = active & ~hit
+        if shootable.any() and b_active.any():
+            bdx = bxs[None, :] - xs[:, None]
+            bdy = bys[None, :] - ys[:, None]
+            hit_bullet = ((bdx * bdx + bdy * bdy < cls.bullet_reach ** 2) &
+                          b_active[None, :] & shootable[:, None])
+
+            # Each bullet takes out a single enemy, and each enemy only uses
+            # up the first bullet that hits it.
+            for k in np.flatnonzero(hit_bullet.any(axis=1)):
+                bullets = hit_bullet[k] & b_active
+                if bullets.any():
+                    b = bullets.argmax()
+                    hit[k] = True
+                    b_active[b] = False
+                    bxs[b] = -100
+                    bys[b] = -100
+
+        # Continue moving to the left
+        active &= ~hit
+        xs[active] -= 200 * nap
+
+        # Move vertically. If we're leaving the view, change the vector sign
+        ys[active] += v[active] * nap
+        m = active & (ys <= 0)
+        v[m] = np.abs(v[m])
+        m = active & (ys > parent.height)
+        v[m] = -np.abs(v[m])
+
+        # If we're hit or have left the screen, reset.
+        gone = hit | (active & (xs < -50))
+        active[gone] = False
+        xs[gone] = -100
+        ys[gone] = -100
+
+        # Spawn a new enemy on the ones that weren't active this frame
+        delay = parent.spawn_delay
+        if delay <= 0:
+            width, height = parent.width, parent.height
+            for k in np.flatnonzero(idle):
+                active[k] = True
+                xs[k] = width + 50
+                ys[k] = height * random()
+                v[k] = randint(-100, 100)
+                delay += 1
+                if delay > 0:
+                    break
+            parent.spawn_delay = delay
 
 
 class Game(PSWidget):
 
     glsl = 'assets/shaders/shmup.glsl'
     atlas = 'assets/images/shmup.atlas'
+    max_particles = 551
 
     player_x, player_y = Window.mouse_pos
     firing = False
     fire_delay = 0
     spawn_delay = 1
+    star_rate = 30
 
     def __init__(self, **kwargs):
         super(Game, self).__init__(**kwargs)
@@ -369,16 +614,60 @@ class Game(PSWidget):
         self.firing = False
 
     def initialize(self):
-        self.make_particles(Star, 300)
-        self.make_particles(Trail, 200)
-        self.make_particles(Player, 1)
-        self.make_particles(Enemy, 25)
-        self.make_particles(Bullet, 25)
+        self.active = np.zeros(self.max_particles, dtype=bool)
+
+        self.star_slice = self.make_particles(Star, 300)
+        s = self.star_slice
+        self.star_state = np.stack((self.xs[s], self.ys[s], self.sizes[s]))
+        self.star_generation = self.star_synced = 0
+        self.star_lock = threading.Lock()
+        self.star_stop = threading.Event()
+
+        self.trail_slice = self.make_particles(Trail, 200)
+        self.player_slice = self.make_particles(Player, 1)
+        self.enemy_slice = self.make_particles(Enemy, 25)
+        self.enemy_v = np.zeros(25, dtype=np.float32)
+        self.bullet_slice = self.make_particles(Bullet, 25)
+
+        # Daemonized so a crash that skips `shutdown` can't keep the process
+        # alive.
+        self.star_thread = threading.Thread(target=self.star_loop,
+                                            daemon=True)
+        self.star_thread.start()
+
+    def star_loop(self):
+        """ Keep the starfield moving `star_rate` times per second until
+        `shutdown` is called.
+
+        The stars are advanced on a private copy of `star_state` and the lock
+        is only held while publishing the result, so the render thread always
+        reads a consistent snapshot. Each publish bumps `star_generation`.
+
+        """
+        xs, ys, sizes = self.star_state.copy()
+        last = time.monotonic()
+
+        while not self.star_stop.wait(1.0 / self.star_rate):
+            now = time.monotonic()
+            Star.advance_field(xs, ys, sizes, now - last, self.width,
+                               self.height)
+            last = now
 
-        self.bullets = self.particles[-25:]
+            with self.star_lock:
+                self.star_state[:] = xs, ys, sizes
+                self.star_generation += 1
+
+    def shutdown(self):
+        """ Stop the starfield thread and wait for it to finish.
+
+        """
+        self.star_stop.set()
+        self.star_thread.join()
 
     def update_glsl(self, nap):
         self.player_x, self.player_y = Window.mouse_pos
+        self.xs[self.player_slice] = self.player_x
+        self.ys[self.player_slice] = self.player_y
 
         if self.firing:
             self.fire_delay -= nap
@@ -397,3 +686,6 @@ class GameApp(App):
     def on_start(self):
         self.root.initialize()
         Clock.schedule_interval(self.root.update_glsl, 1 / 60.0)
+
+    def on_stop(self):
+        self.root.shutdown()